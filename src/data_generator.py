@@ -1,5 +1,12 @@
+import csv
+import gzip
+import pickle
+import sys
 import xml.etree.ElementTree as ET
+from array import array
+from collections import deque
 import networkx as nx
+import numpy
 from typing import List, Set, Tuple, Dict
 from os.path import join, exists
 from argparse import ArgumentParser
@@ -11,55 +18,90 @@ from omegaconf import OmegaConf, DictConfig
 from multiprocessing import cpu_count, Manager, Pool, Queue
 import functools
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 USE_CPU = cpu_count()
 
+# joern code fields can exceed the csv module's default 128 KiB field limit
+csv.field_size_limit(sys.maxsize)
+
+_ARITH_OPS = frozenset(('+', '-', '*', '/'))
+
+# gzip XFG pickles at least this large; nx.read_gpickle decompresses .gz
+# transparently, so readers are unaffected
+COMPRESS_MIN_BYTES = 64 * 1024
+
+
+@dataclasses.dataclass
+class CsvColumns:
+    """
+    column-wise content of a joern csv file, one array per column
+    """
+    columns: Dict[str, numpy.ndarray]
+    row_ct: int
+
+    def __len__(self) -> int:
+        return self.row_ct
+
+    def column(self, name: str) -> numpy.ndarray:
+        """
+        return the column array, empty strings if the column is missing
+        """
+        if name not in self.columns:
+            self.columns[name] = numpy.full(self.row_ct, '', dtype=object)
+        return self.columns[name]
 
-def extract_line_number(idx: int, nodes: List) -> int:
+
+def build_line_numbers(locations: numpy.ndarray) -> numpy.ndarray:
     """
-    return the line number of node index
+    precompute the line number of every node index
+
+    for each index this is the line number of the last node at or before it
+    that carries location info, -1 if there is none
 
     Args:
-        idx (int): node index
-        nodes (List)
-    Returns: line number of node idx
+        locations (numpy.ndarray): location column of nodes.csv
+    Returns: line number per node index (int32 array)
     """
-    while idx >= 0:
-        c_node = nodes[idx]
-        if 'location' in c_node.keys():
-            location = c_node['location']
-            if location.strip() != '':
-                try:
-                    ln = int(location.split(':')[0])
-                    return ln
-                except Exception as e:
-                    print(e)
-                    pass
-        idx -= 1
-    return -1
-
-
-def read_csv(csv_file_path: str) -> List:
+    row_ct = len(locations)
+    lines = numpy.full(row_ct, -1, dtype=numpy.int32)
+    for idx in numpy.nonzero(locations != '')[0]:
+        try:
+            lines[idx] = int(locations[idx].split(':', 1)[0])
+        except Exception as e:
+            print(e)
+    # forward-fill: index of the last valid entry at or before each row
+    fill_idx = numpy.where(lines >= 0, numpy.arange(row_ct), 0)
+    numpy.maximum.accumulate(fill_idx, out=fill_idx)
+    return lines[fill_idx]
+
+
+def read_csv(csv_file_path: str) -> CsvColumns:
     """
     read csv file
     """
     assert exists(csv_file_path), f"no {csv_file_path}"
-    data = []
-    with open(csv_file_path) as fp:
-        header = fp.readline()
-        header = header.strip()
-        h_parts = [hp.strip() for hp in header.split('\t')]
-        for line in fp:
-            line = line.strip()
-            instance = {}
-            lparts = line.split('\t')
-            for i, hp in enumerate(h_parts):
-                if i < len(lparts):
-                    content = lparts[i].strip()
-                else:
-                    content = ''
-                instance[hp] = content
-            data.append(instance)
-        return data
+    row_ct = 0
+    with open(csv_file_path, newline='') as fp:
+        reader = csv.reader(fp, delimiter='\t', quoting=csv.QUOTE_NONE)
+        h_parts = [hp.strip() for hp in next(reader, [])]
+        n_cols = len(h_parts)
+        col_lists: List[List[str]] = [[] for _ in h_parts]
+        col_appends = [col_list.append for col_list in col_lists]
+        for lparts in reader:
+            if len(lparts) < n_cols:
+                lparts.extend([''] * (n_cols - len(lparts)))
+            for append, content in zip(col_appends, map(str.strip, lparts)):
+                append(content)
+            row_ct += 1
+    columns = {
+        hp: numpy.array(col_list, dtype=object)
+        for hp, col_list in zip(h_parts, col_lists)
+    }
+    return CsvColumns(columns, row_ct)
 
 
 def extract_nodes_with_location_info(nodes):
@@ -71,25 +113,32 @@ def extract_nodes_with_location_info(nodes):
 
     """
 
-    node_indices = []
-    node_ids = []
-    line_numbers = []
-    node_id_to_line_number = {}
-    for node_index, node in enumerate(nodes):
-        assert isinstance(node, dict)
-        if 'location' in node.keys():
-            location = node['location']
-            if location == '':
-                continue
-            line_num = int(location.split(':')[0])
-            node_id = node['key'].strip()
-            node_indices.append(node_index)
-            node_ids.append(node_id)
-            line_numbers.append(line_num)
-            node_id_to_line_number[node_id] = line_num
+    locations = nodes.column('location')
+    node_indices = numpy.nonzero(locations != '')[0]
+    node_ids = nodes.column('key')[node_indices].tolist()
+    line_numbers = [
+        int(locations[node_index].split(':', 1)[0])
+        for node_index in node_indices
+    ]
+    node_id_to_line_number = dict(zip(node_ids, line_numbers))
     return node_indices, node_ids, line_numbers, node_id_to_line_number
 
 
+@functools.lru_cache(maxsize=4)
+def load_sensi_apis(sensi_api_path: str) -> frozenset:
+    """
+    read the sensitive api set, cached per path so each worker process
+    parses the file only once
+
+    Args:
+        sensi_api_path (str): path to sensitive apis
+    Returns: sensitive api set
+    """
+    assert exists(sensi_api_path), f"{sensi_api_path} not exists!"
+    with open(sensi_api_path, "r", encoding="utf-8") as f:
+        return frozenset(api.strip() for api in f.read().split(","))
+
+
 def build_PDG(code_path: str, sensi_api_path: str,
               source_path: str) -> Tuple[nx.DiGraph, Dict[str, Set[int]]]:
     """
@@ -104,62 +153,58 @@ def build_PDG(code_path: str, sensi_api_path: str,
     """
     nodes_path = join(code_path, "nodes.csv")
     edges_path = join(code_path, "edges.csv")
-    assert exists(sensi_api_path), f"{sensi_api_path} not exists!"
-    with open(sensi_api_path, "r", encoding="utf-8") as f:
-        sensi_api_set = set([api.strip() for api in f.read().split(",")])
+    sensi_api_set = load_sensi_apis(sensi_api_path)
     if not exists(nodes_path) or not exists(edges_path):
         return None, None
     nodes = read_csv(nodes_path)
     edges = read_csv(edges_path)
-    call_lines = set()
-    array_lines = set()
-    ptr_lines = set()
-    arithmatic_lines = set()
     if len(nodes) == 0:
         return None, None
-    for node_idx, node in enumerate(nodes):
-        ntype = node['type'].strip()
-        if ntype == 'CallExpression':
-            function_name = nodes[node_idx + 1]['code']
-            if function_name is None or function_name.strip() == '':
-                continue
-            if function_name.strip() in sensi_api_set:
-                line_no = extract_line_number(node_idx, nodes)
-                if line_no > 0:
-                    call_lines.add(line_no)
-        elif ntype == 'ArrayIndexing':
-            line_no = extract_line_number(node_idx, nodes)
-            if line_no > 0:
-                array_lines.add(line_no)
-        elif ntype == 'PtrMemberAccess':
-            line_no = extract_line_number(node_idx, nodes)
-            if line_no > 0:
-                ptr_lines.add(line_no)
-        elif node['operator'].strip() in ['+', '-', '*', '/']:
-            line_no = extract_line_number(node_idx, nodes)
-            if line_no > 0:
-                arithmatic_lines.add(line_no)
+    ntypes = nodes.column('type')
+    codes = nodes.column('code')
+    line_of = build_line_numbers(nodes.column('location'))
+
+    def key_lines_of(mask: numpy.ndarray) -> Set[int]:
+        lns = line_of[mask]
+        return set(lns[lns > 0].tolist())
+
+    call_mask = ntypes == 'CallExpression'
+    for node_idx in numpy.nonzero(call_mask)[0]:
+        function_name = codes[node_idx + 1] if node_idx + 1 < len(codes) else ''
+        if function_name == '' or function_name not in sensi_api_set:
+            call_mask[node_idx] = False
+    call_lines = key_lines_of(call_mask)
+    array_lines = key_lines_of(ntypes == 'ArrayIndexing')
+    ptr_lines = key_lines_of(ntypes == 'PtrMemberAccess')
+    arithmatic_lines = key_lines_of(
+        numpy.isin(nodes.column('operator'), list(_ARITH_OPS))
+        & (ntypes != 'CallExpression') & (ntypes != 'ArrayIndexing')
+        & (ntypes != 'PtrMemberAccess'))
 
     PDG = nx.DiGraph(file_paths=[source_path])
-    control_edges, data_edges = list(), list()
+    ctrl_s, ctrl_e = array('i'), array('i')
+    data_s, data_e = array('i'), array('i')
     node_indices, node_ids, line_numbers, node_id_to_ln = extract_nodes_with_location_info(
         nodes)
-    for edge in edges:
-        edge_type = edge['type'].strip()
-        if True:  # edge_type in ['IS_AST_PARENT', 'FLOWS_TO']:
-            start_node_id = edge['start'].strip()
-            end_node_id = edge['end'].strip()
-            if start_node_id not in node_id_to_ln.keys(
-            ) or end_node_id not in node_id_to_ln.keys():
+    etypes = edges.column('type')
+    starts = edges.column('start')
+    ends = edges.column('end')
+    ln_of = node_id_to_ln.get
+    for edge_type, start_list, end_list in (('CONTROLS', ctrl_s, ctrl_e),
+                                            ('REACHES', data_s, data_e)):
+        type_mask = etypes == edge_type
+        for start_node_id, end_node_id in zip(starts[type_mask],
+                                              ends[type_mask]):
+            start_ln = ln_of(start_node_id)
+            if start_ln is None:
+                continue
+            end_ln = ln_of(end_node_id)
+            if end_ln is None:
                 continue
-            start_ln = node_id_to_ln[start_node_id]
-            end_ln = node_id_to_ln[end_node_id]
-            if edge_type == 'CONTROLS':  # Control
-                control_edges.append((start_ln, end_ln, {"c/d": "c"}))
-            if edge_type == 'REACHES':  # Data
-                data_edges.append((start_ln, end_ln, {"c/d": "d"}))
-    PDG.add_edges_from(control_edges)
-    PDG.add_edges_from(data_edges)
+            start_list.append(start_ln)
+            end_list.append(end_ln)
+    PDG.add_edges_from(zip(ctrl_s, ctrl_e), **{"c/d": "c"})
+    PDG.add_edges_from(zip(data_s, data_e), **{"c/d": "d"})
     return PDG, {
         "call": call_lines,
         "array": array_lines,
@@ -168,6 +213,75 @@ def build_PDG(code_path: str, sensi_api_path: str,
     }
 
 
+def build_csr(adj: List[List[int]]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    flatten an adjacency list into CSR indptr/indices arrays
+    """
+    indptr = numpy.zeros(len(adj) + 1, dtype=numpy.int64)
+    for i, nbrs in enumerate(adj):
+        indptr[i + 1] = indptr[i] + len(nbrs)
+    indices = numpy.array([nb for nbrs in adj for nb in nbrs],
+                          dtype=numpy.int64)
+    return indptr, indices
+
+
+def bfs_slice(pred_indptr: numpy.ndarray, pred_indices: numpy.ndarray,
+              succ_indptr: numpy.ndarray, succ_indices: numpy.ndarray,
+              seed: int, full_size: int) -> numpy.ndarray:
+    """
+    collect the backward- plus forward-reachable node indices of seed
+
+    runs one directed pass over the predecessor CSR adjacency and one over
+    the successor CSR adjacency and returns the union
+
+    Args:
+        pred_indptr (numpy.ndarray): predecessor CSR row pointers
+        pred_indices (numpy.ndarray): predecessor CSR neighbor indices
+        succ_indptr (numpy.ndarray): successor CSR row pointers
+        succ_indices (numpy.ndarray): successor CSR neighbor indices
+        seed (int): start node index
+        full_size (int): size of the seed's component, for early exit
+    Returns: sliced node indices
+    """
+    node_ct = len(pred_indptr) - 1
+    in_slice = numpy.zeros(node_ct, dtype=numpy.uint8)
+    in_slice[seed] = 1
+    reached = numpy.empty(full_size, dtype=numpy.int64)
+    reached[0] = seed
+    reach_ct = 1
+    for direction in range(2):
+        if reach_ct == full_size:
+            break
+        if direction == 0:
+            indptr, indices = pred_indptr, pred_indices
+        else:
+            indptr, indices = succ_indptr, succ_indices
+        visited = numpy.zeros(node_ct, dtype=numpy.uint8)
+        visited[seed] = 1
+        queue = numpy.empty(full_size, dtype=numpy.int64)
+        queue[0] = seed
+        queue_ct = 1
+        head = 0
+        while head < queue_ct and reach_ct < full_size:
+            fro = queue[head]
+            head += 1
+            for j in range(indptr[fro], indptr[fro + 1]):
+                nb = indices[j]
+                if visited[nb] == 0:
+                    visited[nb] = 1
+                    queue[queue_ct] = nb
+                    queue_ct += 1
+                    if in_slice[nb] == 0:
+                        in_slice[nb] = 1
+                        reached[reach_ct] = nb
+                        reach_ct += 1
+    return reached[:reach_ct]
+
+
+if numba is not None:
+    bfs_slice = numba.njit(cache=True)(bfs_slice)
+
+
 def build_XFG(PDG: nx.DiGraph, key_line_map: Dict[str, Set[int]]
                 ) -> Dict[str, List[nx.DiGraph]]:
     """
@@ -181,40 +295,70 @@ def build_XFG(PDG: nx.DiGraph, key_line_map: Dict[str, Set[int]]
         return None
     # ct0, ct1 = 0, 0
     res = {"call": [], "array": [], "ptr": [], "arith": []}
+    # memoize per seed line: the same key line can appear in several of the
+    # four categories, and its slice depends on the seed, not the component
+    slice_of: Dict[int, Set[int]] = {}
+    comp_size: Dict[int, int] = {}
+    for comp in nx.weakly_connected_components(PDG):
+        for comp_ln in comp:
+            comp_size[comp_ln] = len(comp)
+    # remap lines to dense indices so the BFS runs on list indexing instead
+    # of per-step dict hashing
+    nodes_list = list(PDG.nodes())
+    idx_of = {n: i for i, n in enumerate(nodes_list)}
+    pdg_edges = list(PDG.edges(data=True))
+    pred = PDG._pred
+    succ = PDG._succ
+    adj_pred: List[List[int]] = [[idx_of[nb] for nb in pred[n]]
+                                 for n in nodes_list]
+    adj_succ: List[List[int]] = [[idx_of[nb] for nb in succ[n]]
+                                 for n in nodes_list]
+    use_jit = numba is not None
+    if use_jit:
+        pred_indptr, pred_indices = build_csr(adj_pred)
+        succ_indptr, succ_indices = build_csr(adj_succ)
     for key in ["call", "array", "ptr", "arith"]:
         for ln in key_line_map[key]:
-            sliced_lines = set()
-
-            # backward traversal
-            bqueue = list()
-
-            visited = set()
-            bqueue.append(ln)
-            visited.add(ln)
-            while bqueue:
-                fro = bqueue.pop(0)
-                sliced_lines.add(fro)
-                if fro in PDG._pred:
-                    for pred in PDG._pred[fro]:
-                        if pred not in visited:
-                            visited.add(pred)
-                            bqueue.append(pred)
-
-            # forward traversal
-            fqueue = list()
-            visited = set()
-            fqueue.append(ln)
-            visited.add(ln)
-            while fqueue:
-                fro = fqueue.pop(0)
-                sliced_lines.add(fro)
-                if fro in PDG._succ:
-                    for succ in PDG._succ[fro]:
-                        if succ not in visited:
-                            visited.add(succ)
-                            fqueue.append(succ)
+            sliced_lines = slice_of.get(ln)
+            if sliced_lines is None:
+                seed = idx_of.get(ln)
+                if seed is None:
+                    sliced_lines = {ln}
+                else:
+                    full_size = comp_size[ln]
+                    if use_jit:
+                        reached = bfs_slice(pred_indptr, pred_indices,
+                                            succ_indptr, succ_indices, seed,
+                                            full_size).tolist()
+                    else:
+                        # backward traversal over preds, then forward over
+                        # succs; the slice is their union
+                        in_slice = bytearray(len(nodes_list))
+                        in_slice[seed] = 1
+                        reached = [seed]
+                        for adj in (adj_pred, adj_succ):
+                            if len(reached) == full_size:
+                                break
+                            visited = bytearray(len(nodes_list))
+                            visited[seed] = 1
+                            queue = deque((seed,))
+                            while queue and len(reached) < full_size:
+                                fro = queue.popleft()
+                                for nb in adj[fro]:
+                                    if not visited[nb]:
+                                        visited[nb] = 1
+                                        queue.append(nb)
+                                        if not in_slice[nb]:
+                                            in_slice[nb] = 1
+                                            reached.append(nb)
+                    sliced_lines = {nodes_list[i] for i in reached}
+                slice_of[ln] = sliced_lines
             if len(sliced_lines) != 0:
-                XFG = PDG.subgraph(list(sliced_lines)).copy()
+                XFG = nx.DiGraph()
+                XFG.graph.update(PDG.graph)
+                XFG.add_nodes_from(n for n in sliced_lines if n in idx_of)
+                XFG.add_edges_from((u, v, d) for u, v, d in pdg_edges
+                                   if u in sliced_lines and v in sliced_lines)
                 XFG.graph["key_line"] = ln
 
                 res[key].append(XFG)
@@ -274,15 +418,18 @@ def dump_XFG(res: Dict[str, List[nx.DiGraph]], out_root_path: str,
     if res is None:
         return
     testcase_out_root_path = join(out_root_path, testcaseid)
-    if not exists(testcase_out_root_path):
-        os.makedirs(testcase_out_root_path)
     for k in res:
         k_root_path = join(testcase_out_root_path, k)
-        if not exists(k_root_path):
-            os.makedirs(k_root_path)
+        os.makedirs(k_root_path, exist_ok=True)
         for XFG in res[k]:
+            payload = pickle.dumps(XFG, protocol=5)
             out_path = join(k_root_path, f"{XFG.graph['key_line']}.xfg.pkl")
-            nx.write_gpickle(XFG, out_path)
+            if len(payload) >= COMPRESS_MIN_BYTES:
+                with gzip.open(out_path + ".gz", "wb") as f:
+                    f.write(payload)
+            else:
+                with open(out_path, "wb") as f:
+                    f.write(payload)
 
 
 def configure_arg_parser() -> ArgumentParser:
@@ -324,15 +471,38 @@ def handle_queue_message(queue: Queue):
     return xfg_ct
 
 
+def process_one_file(file_path: str, queue: Queue, cwe_root: str,
+                     out_root_path: str):
+    """
+    build and dump XFGs of one source file
+
+    Args:
+        file_path:
+        queue:
+        cwe_root:
+        out_root_path:
+
+    Returns:
+
+    """
+    # 关键在于获取csv路径。很难调
+    csv_path = join(cwe_root, "csv/parsed", os.path.abspath(file_path)[1:],
+                        )
+    source_path = file_path
+    PDG, key_line_map = build_PDG(csv_path, "data/sensiAPI.txt",
+                                      source_path)
+    res = build_XFG(PDG, key_line_map)  # vul_lines 不存在 所以要考虑取消参数
+    queue.put(QueueMessage(res, out_root_path, file_path))
+    return file_path
+
+
 def process_parallel(file_map: List, cwe_root: str,
                      source_root_path: str,
                      out_root_path: str):
     """
 
     Args:
-        testcase:
-        doneIDs:
-        codeIDtoPath:
+        file_map:
         cwe_root:
         source_root_path:
         out_root_path:
@@ -342,22 +512,53 @@ def process_parallel(file_map: List, cwe_root: str,
     """
 
     # 需要构建一个 路径的集合 file_map
-    for file_path in file_map:
-        # print(file_path)
-        # vul_lines = file_map[file_path]  # 测试集不存在 vul_lines
-        # 关键在于获取csv路径。很难调
-        csv_path = join(cwe_root, "csv/parsed", os.path.abspath(file_path)[1:],
-                            )
-        
-        print("csv_path :{}".format(csv_path))
-        source_path = file_path
-        print("source_path:{}".format(source_path))
-        PDG, key_line_map = build_PDG(csv_path, "data/sensiAPI.txt",
-                                          source_path)
-        res = build_XFG(PDG, key_line_map)  # vul_lines 不存在 所以要考虑取消参数
-        # queue.put(QueueMessage(res, out_root_path, testcaseid))
-        dump_XFG(res, out_root_path, file_path)
-    return file_map
+    with Manager() as m:
+        message_queue = m.Queue()  # type: ignore
+        # one extra slot for the queue consumer, which blocks on queue.get()
+        # until the finish sentinel; with exactly USE_CPU slots it would
+        # starve the file workers (and deadlock outright on one cpu)
+        pool = Pool(USE_CPU + 1)
+        xfg_ct = pool.apply_async(handle_queue_message, (message_queue,))
+        process_func = functools.partial(process_one_file,
+                                         queue=message_queue,
+                                         cwe_root=cwe_root,
+                                         out_root_path=out_root_path)
+        files_done: List = [
+            file_path
+            for file_path in tqdm(
+                pool.imap_unordered(process_func, file_map),
+                desc=f"files: ",
+                total=len(file_map),
+            )
+        ]
+        message_queue.put(QueueMessage(None, None, None, True))
+        pool.close()
+        pool.join()
+    print(f"total {xfg_ct.get()} XFGs!")
+    return files_done
+
+
+def iter_source_files(source_root_path: str):
+    """
+    yield every C/C++ source file under source_root_path
+
+    iterative os.scandir walk: reuses the DirEntry type info instead of the
+    extra stat calls os.walk does
+
+    Args:
+        source_root_path:
+
+    Returns:
+
+    """
+    stack = [source_root_path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(('.c', '.cpp', '.h')):
+                    yield entry.path
 
 
 def generate(config_path: str):
@@ -374,17 +575,8 @@ def generate(config_path: str):
     # codeIDtoPath = getCodeIDtoPathDict(testcases, source_root_path)
 
     # 判断有无 doneID.txt 文件，没有就创建一个
-    cnt = 0
-    file_map = []
-    for root, dirs, files in os.walk(source_root_path):
-        for file in files:
-            if file.endswith(".c") or file.endswith(".cpp") or file.endswith(".h"):
-                # print(os.path.join(root,file))
-                file_path = os.path.join(root, file)
-                file_map.append(file_path)
-                cnt += 1
-                
-    print("total file num :{}".format(cnt))
+    file_map = list(iter_source_files(source_root_path))
+    print("total file num :{}".format(len(file_map)))
     #file_map 存储所有的file_path 得到每一个C++ 相关文件的目录
     #解析函数
     #cwe_root :data/CWElibhv